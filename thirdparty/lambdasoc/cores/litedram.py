@@ -1,13 +1,14 @@
 from abc import ABCMeta, abstractmethod
-import csv
+from functools import lru_cache
+from operator import attrgetter
 import jinja2
 import os
-import re
 import textwrap
 
 from amaranth import *
 from amaranth import tracer
 from amaranth.build.run import BuildPlan, BuildProducts
+from amaranth.hdl.rec import Layout
 from amaranth.utils import log2_int
 
 from thirdparty.amaranth_soc import wishbone
@@ -21,10 +22,38 @@ __all__ = [
 ]
 
 
+def _dedent_strip(source):
+    return textwrap.dedent(source).strip()
+
+
+@lru_cache(maxsize=None)
+def _get_module(module_name, clk_freq, rate):
+    import litedram.modules
+    try:
+        module_class = vars(litedram.modules)[module_name]
+    except KeyError:
+        raise ValueError("Unknown DRAM module {!r}".format(module_name)) from None
+    return module_class(clk_freq=clk_freq, rate=rate)
+
+
+_MEMTYPE_RATES = {
+    "DDR2": "1:2",
+    "DDR3": "1:4",
+    "DDR4": "1:4",
+}
+
+_USER_DATA_WIDTHS = frozenset({8, 16, 32, 64, 128})
+_CSR_DATA_WIDTHS  = frozenset({8, 16, 32, 64})
+
+_A7_SPEEDGRADES   = ("-1", "-2", "-2L", "-2G", "-3")
+
+
 class Config(metaclass=ABCMeta):
     _doc_template = """
     {description}
 
+    Integer parameters must be of type :class:`int`; :class:`bool` values are rejected.
+
     Parameters
     ----------
     memtype : str
@@ -58,6 +87,12 @@ class Config(metaclass=ABCMeta):
     """.strip(),
     parameters="",
     )
+    __slots__ = (
+        "memtype", "_rate", "module_name", "module_bytes", "module_ranks",
+        "input_clk_freq", "user_clk_freq", "input_domain", "user_domain",
+        "user_data_width", "cmd_buffer_depth", "csr_data_width", "_user_gran_bits",
+    )
+
     def __init__(self, *,
             memtype,
             module_name,
@@ -71,28 +106,25 @@ class Config(metaclass=ABCMeta):
             cmd_buffer_depth = 16,
             csr_data_width   = 32):
 
-        if memtype == "DDR2":
-            rate = "1:2"
-        elif memtype in {"DDR3", "DDR4"}:
-            rate = "1:4"
-        else:
+        if memtype not in _MEMTYPE_RATES:
             raise ValueError("Unsupported DRAM type, must be one of \"DDR2\", \"DDR3\" or "
                              "\"DDR4\", not {!r}"
                              .format(memtype))
+        rate = _MEMTYPE_RATES[memtype]
 
         if not isinstance(module_name, str):
             raise ValueError("Module name must be a string, not {!r}"
                              .format(module_name))
-        if not isinstance(module_bytes, int) or module_bytes <= 0:
+        if type(module_bytes) is not int or module_bytes <= 0:
             raise ValueError("Number of byte groups must be a positive integer, not {!r}"
                              .format(module_bytes))
-        if not isinstance(module_ranks, int) or module_ranks <= 0:
+        if type(module_ranks) is not int or module_ranks <= 0:
             raise ValueError("Number of ranks must be a positive integer, not {!r}"
                              .format(module_ranks))
-        if not isinstance(input_clk_freq, int) or input_clk_freq <= 0:
+        if type(input_clk_freq) is not int or input_clk_freq <= 0:
             raise ValueError("Input clock frequency must be a positive integer, not {!r}"
                              .format(input_clk_freq))
-        if not isinstance(user_clk_freq, int) or user_clk_freq <= 0:
+        if type(user_clk_freq) is not int or user_clk_freq <= 0:
             raise ValueError("User clock frequency must be a positive integer, not {!r}"
                              .format(user_clk_freq))
         if not isinstance(input_domain, str):
@@ -101,14 +133,14 @@ class Config(metaclass=ABCMeta):
         if not isinstance(user_domain, str):
             raise ValueError("User domain name must be a string, not {!r}"
                              .format(user_domain))
-        if user_data_width not in {8, 16, 32, 64, 128}:
+        if user_data_width not in _USER_DATA_WIDTHS:
             raise ValueError("User port data width must be one of 8, 16, 32, 64 or 128, "
                              "not {!r}"
                              .format(user_data_width))
-        if not isinstance(cmd_buffer_depth, int) or cmd_buffer_depth <= 0:
+        if type(cmd_buffer_depth) is not int or cmd_buffer_depth <= 0:
             raise ValueError("Command buffer depth must be a positive integer, not {!r}"
                              .format(cmd_buffer_depth))
-        if csr_data_width not in {8, 16, 32, 64}:
+        if csr_data_width not in _CSR_DATA_WIDTHS:
             raise ValueError("CSR data width must be one of 8, 16, 32, or 64, not {!r}"
                              .format(csr_data_width))
 
@@ -125,6 +157,8 @@ class Config(metaclass=ABCMeta):
         self.cmd_buffer_depth = cmd_buffer_depth
         self.csr_data_width   = csr_data_width
 
+        self._user_gran_bits  = log2_int(user_data_width // 8)
+
     @property
     @abstractmethod
     def phy_name(self):
@@ -138,13 +172,10 @@ class Config(metaclass=ABCMeta):
         Return value
         ------------
         An instance of :class:`litedram.modules.SDRAMModule`, describing its geometry and timings.
+        Module descriptions are cached, and shared between configurations with the same module
+        name, user clock frequency and rate.
         """
-        import litedram.modules
-        module_class = getattr(litedram.modules, self.module_name)
-        module = module_class(
-            clk_freq = self.user_clk_freq,
-            rate     = self._rate,
-        )
+        module = _get_module(self.module_name, self.user_clk_freq, self._rate)
         assert module.memtype == self.memtype
         return module
 
@@ -187,10 +218,12 @@ class ECP5Config(Config):
         Frequency of the PHY initialization clock, which is generated by the internal PLL.
     """.strip(),
     )
+    __slots__ = ("init_clk_freq",)
+
     def __init__(self, *, init_clk_freq, **kwargs):
         super().__init__(**kwargs)
 
-        if not isinstance(init_clk_freq, int) or init_clk_freq <= 0:
+        if type(init_clk_freq) is not int or init_clk_freq <= 0:
             raise ValueError("Init clock frequency must be a positive integer, not {!r}"
                              .format(init_clk_freq))
         self.init_clk_freq = init_clk_freq
@@ -218,6 +251,10 @@ class Artix7Config(Config):
         IODELAY reference clock frequency.
     """.strip(),
     )
+    __slots__ = (
+        "speedgrade", "cmd_latency", "rtt_nom", "rtt_wr", "ron", "iodelay_clk_freq",
+    )
+
     def __init__(self, *,
             speedgrade,
             cmd_latency,
@@ -228,26 +265,25 @@ class Artix7Config(Config):
             **kwargs):
         super().__init__(**kwargs)
 
-        speedgrades = ("-1", "-2", "-2L", "-2G", "-3")
-        if speedgrade not in speedgrades:
+        if speedgrade not in _A7_SPEEDGRADES:
             raise ValueError("Speed grade must be one of \'{}\', not {!r}"
-                             .format("\', \'".join(speedgrades), speedgrade))
-        if not isinstance(cmd_latency, int) or cmd_latency < 0:
+                             .format("\', \'".join(_A7_SPEEDGRADES), speedgrade))
+        if type(cmd_latency) is not int or cmd_latency < 0:
             raise ValueError("Command latency must be a non-negative integer, not {!r}"
                              .format(cmd_latency))
-        if not isinstance(rtt_nom, int) or rtt_nom < 0:
+        if type(rtt_nom) is not int or rtt_nom < 0:
             raise ValueError("Nominal termination impedance must be a non-negative integer, "
                              "not {!r}"
                              .format(rtt_nom))
-        if not isinstance(rtt_wr, int) or rtt_wr < 0:
+        if type(rtt_wr) is not int or rtt_wr < 0:
             raise ValueError("Write termination impedance must be a non-negative integer, "
                              "not {!r}"
                              .format(rtt_wr))
-        if not isinstance(ron, int) or ron < 0:
+        if type(ron) is not int or ron < 0:
             raise ValueError("Output driver impedance must be a non-negative integer, "
                              "not {!r}"
                              .format(ron))
-        if not isinstance(iodelay_clk_freq, int) or iodelay_clk_freq <= 0:
+        if type(iodelay_clk_freq) is not int or iodelay_clk_freq <= 0:
             raise ValueError("IODELAY clock frequency must be a positive integer, not {!r}"
                              .format(iodelay_clk_freq))
 
@@ -259,6 +295,31 @@ class Artix7Config(Config):
         self.iodelay_clk_freq = iodelay_clk_freq
 
 
+@lru_cache(maxsize=128)
+def _native_port_layout(addr_width, data_width, we_width):
+    # Layouts are never mutated by Record, so they can be shared between native ports.
+    return Layout([
+        ("cmd", [
+            ("valid", 1),
+            ("ready", 1),
+            ("last",  1),
+            ("we",    1),
+            ("addr",  addr_width),
+        ]),
+        ("w", [
+            ("valid", 1),
+            ("ready", 1),
+            ("data",  data_width),
+            ("we",    we_width),
+        ]),
+        ("r", [
+            ("valid", 1),
+            ("ready", 1),
+            ("data",  data_width),
+        ]),
+    ])
+
+
 class NativePort(Record):
     """LiteDRAM native port interface.
 
@@ -301,6 +362,8 @@ class NativePort(Record):
     r.data : Signal(data_width), out
         Read data.
     """
+    __slots__ = ()
+
     def __init__(self, *, addr_width, data_width, name=None, src_loc_at=0):
         if not isinstance(addr_width, int) or addr_width <= 0:
             raise ValueError("Address width must be a positive integer, not {!r}"
@@ -314,26 +377,11 @@ class NativePort(Record):
         self.granularity = 8
         self._map        = None
 
-        super().__init__([
-            ("cmd", [
-                ("valid", 1),
-                ("ready", 1),
-                ("last",  1),
-                ("we",    1),
-                ("addr",  addr_width),
-            ]),
-            ("w", [
-                ("valid", 1),
-                ("ready", 1),
-                ("data",  data_width),
-                ("we",    data_width // self.granularity),
-            ]),
-            ("r", [
-                ("valid", 1),
-                ("ready", 1),
-                ("data",  data_width),
-            ]),
-        ], name=name, src_loc_at=1 + src_loc_at)
+        # `data_width` is a power of two, so `log2(data_width // 8)` is its bit length minus 4.
+        self._granularity_bits = max(0, data_width.bit_length() - 4)
+
+        super().__init__(_native_port_layout(addr_width, data_width, data_width >> 3),
+                         name=name, src_loc_at=1 + src_loc_at)
 
     @property
     def memory_map(self):
@@ -361,7 +409,7 @@ class NativePort(Record):
             raise ValueError("Memory map has data width {}, which is not the same as native port "
                              "granularity {}"
                              .format(memory_map.data_width, 8))
-        granularity_bits = log2_int(self.data_width // 8)
+        granularity_bits = self._granularity_bits
         if memory_map.addr_width != max(1, self.addr_width + granularity_bits):
             raise ValueError("Memory map has address width {}, which is not the same as native "
                              "port address width {} ({} address bits + {} granularity bits)"
@@ -413,20 +461,18 @@ class Core(Elaboratable):
         self.name = name or tracer.get_var_name(depth=2 + src_loc_at)
 
         module = config.get_module()
-        size   = config.module_bytes \
-               * 2**( module.geom_settings.bankbits
-                    + module.geom_settings.rowbits
-                    + module.geom_settings.colbits)
+        geom   = module.geom_settings
+        size   = config.module_bytes << (geom.bankbits + geom.rowbits + geom.colbits)
 
         self.size = size
 
-        user_addr_width = module.geom_settings.rowbits \
-                        + module.geom_settings.colbits \
+        user_addr_width = geom.rowbits \
+                        + geom.colbits \
                         + log2_int(module.nbanks) \
                         + max(log2_int(config.module_ranks), 1)
 
         self.user_port = NativePort(
-            addr_width = user_addr_width - log2_int(config.user_data_width // 8),
+            addr_width = user_addr_width - config._user_gran_bits,
             data_width = config.user_data_width,
         )
         user_map = MemoryMap(addr_width=user_addr_width, data_width=8)
@@ -468,15 +514,19 @@ class Core(Elaboratable):
         # LiteDRAM's Wishbone to CSR bridge has a granularity of 8 bits.
         ctrl_map = MemoryMap(addr_width=1, data_width=8)
 
+        # Each CSR occupies `csr_data_width // 8` bytes of the control bus per unit of size.
+        ratio = self.config.csr_data_width // ctrl_map.data_width
+
         csr_csv = build_products.get(f"{self.name}_csr.csv", mode="t")
-        for row in csv.reader(csr_csv.split("\n"), delimiter=","):
-            if not row or row[0][0] == "#": continue
-            res_type, res_name, addr, size, attrs = row
+        # LiteDRAM writes unquoted fields without embedded commas, so rows can be split as-is.
+        for line in csr_csv.splitlines():
+            if not line or line[0] == "#": continue
+            res_type, res_name, addr, size, attrs = line.split(",", 4)
             if res_type == "csr_register":
                 ctrl_map.add_resource(
                     res_name,
                     addr   = int(addr, 16),
-                    size   = int(size, 10) * self.config.csr_data_width // ctrl_map.data_width,
+                    size   = int(size, 10) * ratio,
                     extend = True,
                 )
 
@@ -553,46 +603,53 @@ class Core(Elaboratable):
         }
 
         if self._pins is not None:
-            core_kwargs.update({
-                "o_ddram_a"     : self._pins.a,
-                "o_ddram_ba"    : self._pins.ba,
-                "o_ddram_ras_n" : self._pins.ras,
-                "o_ddram_cas_n" : self._pins.cas,
-                "o_ddram_we_n"  : self._pins.we,
-                "o_ddram_dm"    : self._pins.dm,
-                "o_ddram_clk_p" : self._pins.clk.p,
-                "o_ddram_cke"   : self._pins.clk_en,
-                "o_ddram_odt"   : self._pins.odt,
-            })
+            phy_pins = _PHY_PINS.get(self.config.phy_name)
+            assert phy_pins is not None
+            core_kwargs.update(_pins_to_kwargs(self._pins, phy_pins))
 
             if hasattr(self._pins, "cs"):
-                core_kwargs.update({
-                    "o_ddram_cs_n" : self._pins.cs,
-                })
-
+                core_kwargs["o_ddram_cs_n"] = self._pins.cs
             if hasattr(self._pins, "rst"):
-                core_kwargs.update({
-                    "o_ddram_reset_n" : self._pins.rst,
-                })
-
-            if isinstance(self.config, ECP5Config):
-                core_kwargs.update({
-                    "i_ddram_dq"    : self._pins.dq,
-                    "i_ddram_dqs_p" : self._pins.dqs.p,
-                })
-            elif isinstance(self.config, Artix7Config):
-                core_kwargs.update({
-                    "io_ddram_dq"    : self._pins.dq,
-                    "io_ddram_dqs_p" : self._pins.dqs.p,
-                    "io_ddram_dqs_n" : self._pins.dqs.n,
-                    "o_ddram_clk_n"  : self._pins.clk.n,
-                })
-            else:
-                assert False
+                core_kwargs["o_ddram_reset_n"] = self._pins.rst
 
         return Instance(f"{self.name}", **core_kwargs)
 
 
+def _pin_map(*pairs):
+    return tuple((kwarg, attrgetter(path)) for kwarg, path in pairs)
+
+def _pins_to_kwargs(pins, pin_map):
+    return {kwarg: getter(pins) for kwarg, getter in pin_map}
+
+
+# DRAM pins shared by all PHYs, as `(Instance keyword argument, pin attribute path)` pairs.
+_DDRAM_PINS = _pin_map(
+    ("o_ddram_a",      "a"),
+    ("o_ddram_ba",     "ba"),
+    ("o_ddram_ras_n",  "ras"),
+    ("o_ddram_cas_n",  "cas"),
+    ("o_ddram_we_n",   "we"),
+    ("o_ddram_dm",     "dm"),
+    ("o_ddram_clk_p",  "clk.p"),
+    ("o_ddram_cke",    "clk_en"),
+    ("o_ddram_odt",    "odt"),
+)
+
+# DRAM pins of each PHY, indexed by :attr:`Config.phy_name`.
+_PHY_PINS = {
+    ECP5Config.phy_name: _DDRAM_PINS + _pin_map(
+        ("i_ddram_dq",     "dq"),
+        ("i_ddram_dqs_p",  "dqs.p"),
+    ),
+    Artix7Config.phy_name: _DDRAM_PINS + _pin_map(
+        ("io_ddram_dq",    "dq"),
+        ("io_ddram_dqs_p", "dqs.p"),
+        ("io_ddram_dqs_n", "dqs.n"),
+        ("o_ddram_clk_n",  "clk.n"),
+    ),
+}
+
+
 class Builder:
     file_templates = {
         "build_{{top.name}}.sh": r"""
@@ -705,6 +762,35 @@ class Builder:
     def __init__(self):
         self.namespace = set()
 
+        self._file_templates = [
+            (self._compile_filename(filename_tpl),
+             self._compile(content_tpl, origin=content_tpl))
+            for filename_tpl, content_tpl in self.file_templates.items()
+        ]
+        self._command_templates = [
+            self._compile(command_tpl, origin="<command#{}>".format(index + 1))
+            for index, command_tpl in enumerate(self.command_templates)
+        ]
+
+    @classmethod
+    def _compile_filename(cls, source):
+        # Filenames that only refer to `{{top.name}}` are expanded with `str.format` instead of
+        # Jinja. Other filename templates are returned as compiled Jinja templates.
+        source  = _dedent_strip(source)
+        literal = source.replace("{{top.name}}", "")
+        if "{" not in literal and "}" not in literal:
+            return source.replace("{{top.name}}", "{name}")
+        return cls._compile(source, origin=source)
+
+    @staticmethod
+    def _compile(source, origin):
+        try:
+            source = _dedent_strip(source)
+            return jinja2.Template(source, trim_blocks=True, lstrip_blocks=True)
+        except jinja2.TemplateSyntaxError as e:
+            e.args = ("{} (at {}:{})".format(e.message, origin, e.lineno),)
+            raise
+
     def prepare(self, core, *, sim=False, name_force=False):
         """Prepare a build plan.
 
@@ -741,30 +827,25 @@ class Builder:
 
         autogenerated = f"Automatically generated by LambdaSoC. Do not edit."
 
-        def emit_commands():
-            commands = []
-            for index, command_tpl in enumerate(self.command_templates):
-                command = render(command_tpl, origin="<command#{}>".format(index + 1))
-                command = re.sub(r"\s+", " ", command)
-                commands.append(command)
-            return "\n".join(commands)
-
-        def render(source, origin):
-            try:
-                source = textwrap.dedent(source).strip()
-                compiled = jinja2.Template(source, trim_blocks=True, lstrip_blocks=True)
-            except jinja2.TemplateSyntaxError as e:
-                e.args = ("{} (at {}:{})".format(e.message, origin, e.lineno),)
-                raise
-            return compiled.render({
-                "autogenerated": autogenerated,
-                "emit_commands": emit_commands,
-                "sim": sim,
-                "top": core,
-            })
+        context = {
+            "autogenerated": autogenerated,
+            "sim": sim,
+            "top": core,
+        }
+
+        # Commands only depend on the core and simulation mode; render them once per build plan.
+        commands = "\n".join(" ".join(command_tpl.render(context).split())
+                             for command_tpl in self._command_templates)
+        context["emit_commands"] = lambda: commands
+
+        def render(compiled):
+            return compiled.render(context)
 
         plan = BuildPlan(script=f"build_{core.name}")
-        for filename_tpl, content_tpl in self.file_templates.items():
-            plan.add_file(render(filename_tpl, origin=filename_tpl),
-                          render(content_tpl,  origin=content_tpl))
+        for filename_tpl, content_tpl in self._file_templates:
+            if isinstance(filename_tpl, str):
+                filename = filename_tpl.format(name=core.name)
+            else:
+                filename = render(filename_tpl)
+            plan.add_file(filename, render(content_tpl))
         return plan
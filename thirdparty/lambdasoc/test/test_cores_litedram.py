@@ -2,6 +2,7 @@
 
 import unittest
 
+from amaranth.build.run import BuildProducts
 from amaranth_soc.memory import MemoryMap
 
 from litedram.modules import SDRAMModule
@@ -13,6 +14,15 @@ class DummyConfig(litedram.Config):
     phy_name = "dummy"
 
 
+class MockBuildProducts(BuildProducts):
+    def __init__(self, files):
+        self._files = files
+
+    def get(self, filename, mode="b"):
+        super().get(filename, mode)
+        return self._files[filename]
+
+
 class ConfigTestCase(unittest.TestCase):
     def test_simple(self):
         cfg = DummyConfig(
@@ -52,6 +62,20 @@ class ConfigTestCase(unittest.TestCase):
         )
         module = cfg.get_module()
         self.assertIsInstance(module, SDRAMModule)
+        self.assertIs(cfg.get_module(), module)
+
+    def test_get_module_wrong_name(self):
+        cfg = DummyConfig(
+            memtype        = "DDR3",
+            module_name    = "foo",
+            module_bytes   = 2,
+            module_ranks   = 1,
+            input_clk_freq = int(100e6),
+            user_clk_freq  = int(70e6),
+        )
+        with self.assertRaisesRegex(ValueError,
+                r"Unknown DRAM module 'foo'"):
+            cfg.get_module()
 
     def test_wrong_memtype(self):
         with self.assertRaisesRegex(ValueError,
@@ -90,6 +114,18 @@ class ConfigTestCase(unittest.TestCase):
                 user_clk_freq  = int(70e6),
             )
 
+    def test_wrong_module_bytes_bool(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of byte groups must be a positive integer, not True"):
+            cfg = DummyConfig(
+                memtype        = "DDR3",
+                module_name    = "MT41K256M16",
+                module_bytes   = True,
+                module_ranks   = 1,
+                input_clk_freq = int(100e6),
+                user_clk_freq  = int(70e6),
+            )
+
     def test_wrong_module_ranks(self):
         with self.assertRaisesRegex(ValueError,
                 r"Number of ranks must be a positive integer, not 'foo'"):
@@ -430,6 +466,38 @@ class CoreTestCase(unittest.TestCase):
         self.assertEqual(core_1.name, "core")
         self.assertEqual(core_2.name, "core")
 
+    def test_user_map_not_shared(self):
+        core_1 = litedram.Core(self._cfg, name="core_1")
+        core_2 = litedram.Core(self._cfg, name="core_2")
+        self.assertIsNot(core_1.user_port.memory_map, core_2.user_port.memory_map)
+
+    def test_ctrl_bus(self):
+        core = litedram.Core(self._cfg)
+        products = MockBuildProducts({
+            "core_csr.csv":
+                "#--------------------------------------------------------------------------------\n"
+                "# Auto-generated by LiteX\n"
+                "#--------------------------------------------------------------------------------\n"
+                "csr_base,sdram,0x00000000,,\n"
+                "csr_register,sdram_dfii_control,0x00000000,1,rw\n"
+                "csr_register,sdram_dfii_pi0_command,0x00000004,1,rw\n"
+                "csr_register,sdram_dfii_pi0_address,0x0000000c,2,rw\n"
+                "constant,config_clock_frequency,70000000,,\n"
+                "memory_region,main_ram,0x40000000,536870912,cached\n"
+        })
+        core._populate_ctrl_map(products)
+        self.assertEqual(core.ctrl_bus.addr_width, 3)
+        self.assertEqual(core.ctrl_bus.data_width, 32)
+        self.assertEqual(core.ctrl_bus.granularity, 8)
+        ctrl_map = core.ctrl_bus.memory_map
+        self.assertEqual(ctrl_map.addr_width, 5)
+        self.assertEqual(ctrl_map.data_width, 8)
+        self.assertEqual(list(ctrl_map.resources()), [
+            ("sdram_dfii_control",     (0x00, 0x04)),
+            ("sdram_dfii_pi0_command", (0x04, 0x08)),
+            ("sdram_dfii_pi0_address", (0x0c, 0x14)),
+        ])
+
     def test_ctrl_bus_not_ready(self):
         core = litedram.Core(self._cfg)
         with self.assertRaisesRegex(AttributeError,
@@ -467,6 +535,18 @@ class BuilderTestCase(unittest.TestCase):
         builder.prepare(core)
         self.assertEqual(list(builder.namespace), ["core"])
 
+    def test_prepare_build_script(self):
+        core = litedram.Core(self._cfg)
+        builder = litedram.Builder()
+        plan = builder.prepare(core, sim=True)
+        self.assertEqual(
+            plan.files["build_core.sh"],
+            "# Automatically generated by LambdaSoC. Do not edit.\n"
+            "set -e\n"
+            "python -m litedram.gen --name core --output-dir core --gateware-dir core "
+            "--csr-csv core_csr.csv --sim core_config.yml"
+        )
+
     def test_prepare_name_conflict(self):
         core = litedram.Core(self._cfg)
         builder = litedram.Builder()